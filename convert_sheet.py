@@ -2,9 +2,9 @@
 """Convert a scanned piano sheet into MusicXML, PDF, MIDI, and MP3.
 
 This script uses Audiveris to perform optical music recognition on a single-page
-image or PDF and then uses music21 to generate PDF and MIDI renderings of the
-resulting MusicXML file. The MIDI is further converted to MP3 using ``timidity``
-and ``ffmpeg``.
+image or PDF and then uses MuseScore to generate PDF and MIDI renderings of the
+resulting MusicXML file. The MIDI is further converted to MP3 using
+``timidity`` and ``ffmpeg``; music21 is used to display scores for review.
 
 Example:
     python convert_sheet.py input.pdf -o output_dir
@@ -13,40 +13,219 @@ Audiveris must be installed and available on the command line.
 """
 
 import argparse
+import asyncio
+import functools
+import itertools
+import os
 import subprocess
 import sys
+import time
+from collections import deque
 from pathlib import Path
-from typing import Iterable
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from music21 import converter
 import shutil
 
+try:  # optional: used only to cap the default worker count by free memory
+    import psutil
+except ImportError:  # pragma: no cover - psutil is not required
+    psutil = None
+
 
 SUPPORTED_EXTS = {".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff"}
+# Number of trailing Audiveris/MuseScore/ffmpeg stderr lines kept for error reports.
+STDERR_TAIL_LINES = 200
+# Sample rate of the raw PCM stream timidity hands to ffmpeg.
+PCM_SAMPLE_RATE = 44100
+# LAME VBR quality passed to ffmpeg's ``-q:a`` (0 = best, 9 = smallest).
+MP3_VBR_QUALITY = "4"
+# Executable names for each external tool, in order of preference.
+AUDIVERIS = ("audiveris",)
+MSCORE = ("mscore", "musescore")
+TIMIDITY = ("timidity",)
+FFMPEG = ("ffmpeg",)
+
+
+@functools.lru_cache(maxsize=None)
+def _which(name: str) -> Optional[str]:
+    """Return the path of executable ``name`` on ``PATH``, cached per process."""
+    return shutil.which(name)
+
+
+def _tool(names: Tuple[str, ...]) -> str:
+    """Return the resolved path of the first executable in ``names`` on ``PATH``.
+
+    Subprocess argv is built from this path so the child is spawned without
+    another ``PATH`` search.  Raises :class:`FileNotFoundError` if none is
+    installed; :func:`_check_tools` reports that up front for the CLI.
+    """
+    for name in names:
+        path = _which(name)
+        if path:
+            return path
+    raise FileNotFoundError(f"{names[0]} executable not found on PATH")
+
+
+def _check_tools() -> None:
+    """Exit with an error unless every external tool the pipeline needs is on ``PATH``.
+
+    Called once before any file is processed so that a missing tool cannot
+    abort a batch after Audiveris has already done its work.
+    """
+    missing = []
+    for label, names in (
+        ("audiveris", AUDIVERIS),
+        ("MuseScore", MSCORE),
+        ("timidity", TIMIDITY),
+        ("ffmpeg", FFMPEG),
+    ):
+        try:
+            _tool(names)
+        except FileNotFoundError:
+            missing.append(label)
+    for name in missing:
+        print(
+            f"{name} executable not found. Please install {name} and ensure it is on your PATH.",
+            file=sys.stderr,
+        )
+    if missing:
+        sys.exit(1)
+
+
+def _default_jobs() -> int:
+    """Return a conservative default number of concurrent jobs.
+
+    Half the CPUs, and, when :mod:`psutil` is available, no more than one job
+    per GiB of available memory.  A job is either a MuseScore render or a
+    timidity/ffmpeg encode; see :func:`_convert_all`.
+    """
+    jobs = max(1, (os.cpu_count() or 2) // 2)
+    if psutil is not None:
+        jobs = min(jobs, max(1, psutil.virtual_memory().available // (1 << 30)))
+    return jobs
+
+
+def _is_up_to_date(target: Path, source: Path) -> bool:
+    """Return ``True`` if ``target`` exists and is not older than ``source``."""
+    try:
+        return target.stat().st_mtime >= source.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def _run_with_stderr_tail(cmd: List[str]) -> None:
+    """Run ``cmd`` to completion, discarding stdout and keeping only the stderr tail.
+
+    stderr is read while the process runs so a verbose child can never block on
+    a full pipe.  On a non-zero exit :class:`subprocess.CalledProcessError` is
+    raised with the last ``STDERR_TAIL_LINES`` lines attached as ``stderr``.
+    """
+    with subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) as proc:
+        tail = deque(proc.stderr, maxlen=STDERR_TAIL_LINES)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=b"".join(tail))
+
+
+async def _run_with_stderr_tail_async(cmd: List[str]) -> None:
+    """Asynchronous variant of :func:`_run_with_stderr_tail`."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    tail: deque = deque(maxlen=STDERR_TAIL_LINES)
+    async for line in proc.stderr:
+        tail.append(line)
+    if await proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=b"".join(tail))
+
+
+def _is_export_of(path: Path, stem: str, suffix: str) -> bool:
+    """Return ``True`` if ``path`` is an Audiveris ``suffix`` export for ``stem``.
+
+    Matches ``<stem><suffix>`` and movement files such as ``<stem>.mvt1<suffix>``,
+    but not the exports of other inputs sharing the prefix (``<stem>2``,
+    ``<stem>_b``).
+    """
+    name = path.name
+    return name.endswith(suffix) and (name == stem + suffix or name.startswith(stem + "."))
+
+
+def _find_musicxml(
+    input_file: Path, output_dir: Path, not_before: Optional[float] = None
+) -> Optional[Path]:
+    """Return the first MusicXML file Audiveris exported for ``input_file``.
+
+    Only the top level of ``output_dir`` and the per-input folder
+    ``output_dir / input_file.stem`` are searched, so the cost does not grow
+    with the outputs of unrelated inputs.  ``.xml`` files are preferred over
+    ``.mxl`` files, and an exact ``<stem>.xml``/``<stem>.mxl`` over a
+    movement file; the search stops at the first hit.  If ``not_before`` is
+    given, files modified before that timestamp are ignored.
+    """
+
+    def recent(path: Path) -> bool:
+        return not_before is None or path.stat().st_mtime >= not_before
+
+    stem = input_file.stem
+    book_dir = output_dir / stem
+    for suffix in (".xml", ".mxl"):
+        exact = output_dir / f"{stem}{suffix}"
+        if exact.is_file() and recent(exact):
+            return exact
+        pattern = f"{stem}.*{suffix}"
+        candidates = output_dir.glob(pattern)
+        if book_dir.is_dir():
+            candidates = itertools.chain(candidates, book_dir.rglob(f"{stem}*{suffix}"))
+        match = next(
+            (c for c in candidates if _is_export_of(c, stem, suffix) and recent(c)), None
+        )
+        if match is not None:
+            return match
+    return None
 
 
 def run_audiveris(input_file: Path, output_dir: Path) -> Path:
     """Run Audiveris on ``input_file`` and return the generated MusicXML file path.
 
-    After the Audiveris process completes, ``output_dir`` is searched
-    recursively for files matching ``<input_file.stem>*.xml`` or
-    ``<input_file.stem>*.mxl``.  If a match is found the first matching path is
-    returned.  If no MusicXML file is produced an exception is raised.
+    Single-file entry point for library use: this is :func:`run_audiveris_batch`
+    for one input and produces the same ``output_dir`` layout that
+    :func:`process_files` expects.  Prefer the batch form when converting
+    several files, since every Audiveris invocation pays the JVM start-up
+    cost.  If no MusicXML file is produced an exception is raised.
+    """
+    xml_file = run_audiveris_batch([input_file], output_dir).get(input_file)
+    if xml_file is not None:
+        return xml_file
+
+    raise FileNotFoundError(
+        f"Audiveris did not produce a MusicXML file for {input_file} in {output_dir}"
+    )
+
+
+def run_audiveris_batch(input_files: List[Path], output_dir: Path) -> Dict[Path, Path]:
+    """Run Audiveris once on all ``input_files`` and map each input to its MusicXML.
+
+    A single Audiveris invocation avoids paying the JVM start-up cost for every
+    input.  After it completes, each input's MusicXML file is located with
+    :func:`_find_musicxml`; only files written by this run or already newer
+    than their input are accepted, so a stale export is never mistaken for
+    the result of a failed recognition.  Inputs for which no such MusicXML
+    file exists are absent from the returned mapping.  A non-zero Audiveris
+    exit is reported but does not discard the sheets it did export.
     """
     output_dir.mkdir(parents=True, exist_ok=True)
+    # whole seconds: some filesystems store coarser timestamps than time.time()
+    batch_start = float(int(time.time()))
     try:
-        subprocess.run(
+        _run_with_stderr_tail(
             [
-                "audiveris",
+                _tool(AUDIVERIS),
                 "-batch",
-                str(input_file),
                 "-export",
                 "-output",
-                str(output_dir),
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True,
+                os.fspath(output_dir),
+                *map(os.fspath, input_files),
+            ]
         )
     except FileNotFoundError:
         print(
@@ -56,96 +235,253 @@ def run_audiveris(input_file: Path, output_dir: Path) -> Path:
         sys.exit(1)
     except subprocess.CalledProcessError as exc:
         err = exc.stderr.decode().strip() if isinstance(exc.stderr, bytes) else str(exc.stderr)
-        print(f"Audiveris failed to process {input_file}:", file=sys.stderr)
+        what = input_files[0] if len(input_files) == 1 else "the batch"
+        print(f"Audiveris reported errors while processing {what}:", file=sys.stderr)
         if err:
             print(err, file=sys.stderr)
-        sys.exit(1)
+        # fall through: sheets that were exported are still usable
 
-    for pattern in (f"{input_file.stem}*.xml", f"{input_file.stem}*.mxl"):
-        matches = list(output_dir.rglob(pattern))
-        if matches:
-            return matches[0]
+    results: Dict[Path, Path] = {}
+    for input_file in input_files:
+        not_before = min(batch_start, input_file.stat().st_mtime)
+        xml_file = _find_musicxml(input_file, output_dir, not_before)
+        if xml_file is not None:
+            results[input_file] = xml_file
+    return results
 
-    raise FileNotFoundError(
-        f"Audiveris did not produce a MusicXML file for {input_file} in {output_dir}"
-    )
 
+def _mscore_command(xml_file: Path, output_file: Path) -> List[str]:
+    """Return the MuseScore argv converting ``xml_file`` to ``output_file``.
 
-def render_pdf(xml_file: Path, output_file: Path) -> None:
-    """Render ``xml_file`` to ``output_file`` using MuseScore."""
-    try:
-        converter.parse(str(xml_file))  # parse to validate the file
-    except Exception as exc:  # pragma: no cover - defensive catch
-        print(f"Failed to parse {xml_file}: {exc}", file=sys.stderr)
-        return
+    The output format follows from the suffix of ``output_file``.
+    """
+    return [_tool(MSCORE), "-o", os.fspath(output_file), os.fspath(xml_file)]
 
-    mscore_bin = shutil.which("mscore") or shutil.which("musescore")
-    if not mscore_bin:
-        print(
-            "MuseScore executable not found. Please install MuseScore and ensure it is on your PATH.",
-            file=sys.stderr,
-        )
-        sys.exit(1)
 
-    try:
-        subprocess.run([mscore_bin, str(xml_file), "-o", str(output_file)], check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError) as exc:
-        print("Failed to render PDF with MuseScore:", exc, file=sys.stderr)
-        sys.exit(1)
+def render_pdf(xml_file: Path, output_file: Path) -> None:
+    """Render ``xml_file`` to ``output_file`` using MuseScore.
+
+    Raises :class:`subprocess.CalledProcessError` carrying MuseScore's stderr
+    tail if it fails, so that the failure is reported for this file only.
+    """
+    _run_with_stderr_tail(_mscore_command(xml_file, output_file))
 
 
 def render_midi(xml_file: Path, output_file: Path) -> None:
-    """Render ``xml_file`` to ``output_file`` as a MIDI file using music21."""
-    score = converter.parse(str(xml_file))
-    score.write("midi", fp=str(output_file))
+    """Render ``xml_file`` to ``output_file`` as a MIDI file using MuseScore.
 
+    Failures are raised as in :func:`render_pdf`.
+    """
+    _run_with_stderr_tail(_mscore_command(xml_file, output_file))
 
-def midi_to_mp3(midi_file: Path, mp3_file: Path) -> None:
-    """Convert ``midi_file`` to ``mp3_file`` using timidity and ffmpeg."""
-    wav_file = midi_file.with_suffix(".wav")
 
-    if not shutil.which("timidity"):
-        print(
-            "timidity executable not found. Please install timidity and ensure it is on your PATH.",
-            file=sys.stderr,
+def _mp3_commands(midi_file: Path, mp3_file: Path) -> Tuple[List[str], List[str]]:
+    """Return the timidity and ffmpeg argv for piping ``midi_file`` into ``mp3_file``."""
+    # Raw 16-bit signed stereo PCM: no RIFF header for timidity to build and
+    # for ffmpeg to probe; ffmpeg is told the sample format explicitly.
+    timidity_cmd = [
+        _tool(TIMIDITY),
+        os.fspath(midi_file),
+        "-OrS1sl",
+        "-s",
+        str(PCM_SAMPLE_RATE),
+        "-o",
+        "-",
+    ]
+    ffmpeg_cmd = [
+        _tool(FFMPEG),
+        "-y",
+        "-hide_banner",
+        "-nostats",
+        "-loglevel",
+        "error",
+        "-f",
+        "s16le",
+        "-ar",
+        str(PCM_SAMPLE_RATE),
+        "-ac",
+        "2",
+        "-i",
+        "pipe:0",
+        "-c:a",
+        "libmp3lame",
+        "-q:a",
+        MP3_VBR_QUALITY,
+        os.fspath(mp3_file),
+    ]
+    return timidity_cmd, ffmpeg_cmd
+
+
+async def _midi_to_mp3_async(midi_file: Path, mp3_file: Path) -> None:
+    """Convert ``midi_file`` to ``mp3_file`` using timidity and ffmpeg.
+
+    timidity streams raw PCM on stdout straight into ffmpeg's stdin, so no
+    intermediate WAV file is written to disk.  timidity's console output is
+    discarded; ffmpeg runs at ``-loglevel error`` and its stderr tail is
+    attached to the :class:`subprocess.CalledProcessError` raised on failure.
+    """
+    timidity_cmd, ffmpeg_cmd = _mp3_commands(midi_file, mp3_file)
+    read_fd, write_fd = os.pipe()
+    try:
+        timidity = await asyncio.create_subprocess_exec(
+            *timidity_cmd, stdout=write_fd, stderr=subprocess.DEVNULL
         )
-        sys.exit(1)
-    if not shutil.which("ffmpeg"):
-        print(
-            "ffmpeg executable not found. Please install ffmpeg and ensure it is on your PATH.",
-            file=sys.stderr,
+        ffmpeg = await asyncio.create_subprocess_exec(
+            *ffmpeg_cmd,
+            stdin=read_fd,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
         )
-        sys.exit(1)
+    finally:
+        # the children hold their own copies; ours would keep the pipe open
+        os.close(write_fd)
+        os.close(read_fd)
+    timidity_rc, (_, ffmpeg_err) = await asyncio.gather(
+        timidity.wait(), ffmpeg.communicate()
+    )
+    if ffmpeg.returncode:
+        tail = b"".join(ffmpeg_err.splitlines(keepends=True)[-STDERR_TAIL_LINES:])
+        raise subprocess.CalledProcessError(ffmpeg.returncode, ffmpeg_cmd, stderr=tail)
+    if timidity_rc:
+        raise subprocess.CalledProcessError(timidity_rc, timidity_cmd)
 
-    subprocess.run(["timidity", str(midi_file), "-Ow", "-o", str(wav_file)], check=True)
-    subprocess.run(["ffmpeg", "-y", "-i", str(wav_file), str(mp3_file)], check=True)
-    wav_file.unlink(missing_ok=True)
 
+def midi_to_mp3(midi_file: Path, mp3_file: Path) -> None:
+    """Synchronous wrapper around :func:`_midi_to_mp3_async`."""
+    asyncio.run(_midi_to_mp3_async(midi_file, mp3_file))
+
+
+async def _convert_one(
+    xml_file: Path,
+    output_dir: Path,
+    force: bool,
+    job_slots: asyncio.Semaphore,
+) -> List[Tuple[Path, bool]]:
+    """Render ``xml_file`` to PDF and MIDI with MuseScore, then encode its MP3.
+
+    Returns ``(path, regenerated)`` pairs for the PDF, MIDI, and MP3 files.
+    Outputs that are already newer than their input are left alone (and
+    reported with ``regenerated=False``) unless ``force`` is set.
+    """
+    pdf_file = output_dir / f"{xml_file.stem}.pdf"
+    midi_file = output_dir / f"{xml_file.stem}.mid"
+    need_pdf = force or not _is_up_to_date(pdf_file, xml_file)
+    need_midi = force or not _is_up_to_date(midi_file, xml_file)
+    if need_pdf or need_midi:
+        async with job_slots:
+            if need_pdf:
+                await _run_with_stderr_tail_async(_mscore_command(xml_file, pdf_file))
+            if need_midi:
+                await _run_with_stderr_tail_async(_mscore_command(xml_file, midi_file))
+    mp3_file = output_dir / f"{midi_file.stem}.mp3"
+    need_mp3 = force or not _is_up_to_date(mp3_file, midi_file)
+    if need_mp3:
+        async with job_slots:
+            await _midi_to_mp3_async(midi_file, mp3_file)
+    return [(pdf_file, need_pdf), (midi_file, need_midi), (mp3_file, need_mp3)]
+
+
+async def _convert_all(
+    xml_files: List[Path], output_dir: Path, force: bool, workers: int
+) -> list:
+    """Run :func:`_convert_one` for every file; return results or exceptions in order.
+
+    Rendering and encoding draw from one shared budget of ``workers`` slots,
+    so at most ``workers`` MuseScore renders and MP3 encodes run at once in
+    total.
+    """
+    job_slots = asyncio.Semaphore(workers)
+    return await asyncio.gather(
+        *(_convert_one(xml_file, output_dir, force, job_slots) for xml_file in xml_files),
+        return_exceptions=True,
+    )
+
+
+def process_files(
+    files: Iterable[Path],
+    output_dir: Path,
+    review: bool = False,
+    force: bool = False,
+    jobs: Optional[int] = None,
+) -> None:
+    """Convert ``files`` to MusicXML, PDF, MIDI, and MP3.
+
+    Audiveris runs once for the whole batch.  The remaining stages are
+    driven by an asyncio event loop: MuseScore renders the PDF and MIDI as
+    asynchronous subprocesses, and as soon as a file's MIDI is ready its
+    timidity/ffmpeg encode is started the same way, so encoding one file
+    overlaps rendering the next.  Results are reported in input order.  The
+    ``review`` step opens a viewer and therefore always runs serially in the
+    parent process.
+
+    Each stage is skipped when its output is already newer than its input,
+    so re-running over a directory only redoes the work for changed files.
+    Pass ``force=True`` to regenerate everything.
 
-def process_files(files: Iterable[Path], output_dir: Path, review: bool = False) -> None:
+    ``jobs`` is the total number of renders and MP3 encodes allowed to run at
+    once; it defaults to :func:`_default_jobs`.
+    """
+    files = list(files)
+    if not files:
+        return
+
+    xml_files: Dict[Path, Path] = {}
+    if not force:
+        for f in files:
+            xml_file = _find_musicxml(f, output_dir, not_before=f.stat().st_mtime)
+            if xml_file is not None:
+                xml_files[f] = xml_file
+    stale = [f for f in files if f not in xml_files]  # need a fresh Audiveris run
+    if stale:
+        xml_files.update(run_audiveris_batch(stale, output_dir))
+    claimed: Dict[Path, Path] = {}
     for f in files:
+        if f not in xml_files:
+            print(
+                f"Error processing {f}: Audiveris did not produce a MusicXML file in {output_dir}",
+                file=sys.stderr,
+            )
+        elif xml_files[f] in claimed:
+            # e.g. song.png and song.jpg: both would render to the same outputs
+            print(
+                f"Error processing {f}: {xml_files[f]} already belongs to {claimed[xml_files[f]]}",
+                file=sys.stderr,
+            )
+        else:
+            claimed[xml_files[f]] = f
+    files = list(claimed.values())
+    if not files:
+        return
+
+    workers = min(jobs or _default_jobs(), len(files))
+    results = asyncio.run(
+        _convert_all([xml_files[f] for f in files], output_dir, force, workers)
+    )
+
+    for f, result in zip(files, results):
+        xml_file = xml_files[f]
         try:
-            xml_file = run_audiveris(f, output_dir)
-            pdf_file = output_dir / f"{xml_file.stem}.pdf"
-            render_pdf(xml_file, pdf_file)
-            midi_file = output_dir / f"{xml_file.stem}.mid"
-            render_midi(xml_file, midi_file)
-            mp3_file = output_dir / f"{xml_file.stem}.mp3"
-            midi_to_mp3(midi_file, mp3_file)
-            print(f"Generated {xml_file}")
-            print(f"Generated {pdf_file}")
-            print(f"Generated {midi_file}")
-            print(f"Generated {mp3_file}")
+            if isinstance(result, BaseException):
+                raise result
+            outputs = [(xml_file, f in stale)] + result
+            for path, regenerated in outputs:
+                print(f"{'Generated' if regenerated else 'Up to date'} {path}")
+            pdf_file = result[0][0]
             if review:
                 try:
-                    score = converter.parse(str(xml_file))
+                    score = converter.parse(os.fspath(xml_file))
                     score.show()
                 except Exception:
-                    mscore_bin = shutil.which("mscore") or shutil.which("musescore")
-                    if mscore_bin:
-                        subprocess.run([mscore_bin, str(pdf_file)], check=False)
+                    try:
+                        mscore_bin = _tool(MSCORE)
+                    except FileNotFoundError:
+                        continue
+                    subprocess.run([mscore_bin, os.fspath(pdf_file)], check=False)
         except Exception as exc:
             print(f"Error processing {f}: {exc}", file=sys.stderr)
+            err = getattr(exc, "stderr", None)
+            if isinstance(err, bytes) and err.strip():
+                print(err.decode(errors="replace").strip(), file=sys.stderr)
 
 
 def main() -> None:
@@ -165,14 +501,39 @@ def main() -> None:
         action="store_true",
         help="Open each generated score for manual review",
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate all outputs even if they are newer than their inputs",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=_default_jobs(),
+        help="Maximum number of renders and MP3 encodes running at once "
+        "(default: %(default)s)",
+    )
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    _check_tools()
 
     if args.input_path.is_dir():
-        files = [f for f in args.input_path.iterdir() if f.suffix.lower() in SUPPORTED_EXTS]
+        with os.scandir(args.input_path) as it:
+            files = [
+                Path(entry.path)
+                for entry in it
+                if entry.is_file()
+                and os.path.splitext(entry.name)[1].lower() in SUPPORTED_EXTS
+            ]
     else:
         files = [args.input_path]
 
-    process_files(files, args.output_dir, review=args.review)
+    process_files(
+        files, args.output_dir, review=args.review, force=args.force, jobs=args.jobs
+    )
 
 
 if __name__ == "__main__":